@@ -3,13 +3,18 @@
 from __future__ import annotations
 
 import platform
+import threading
 from colorsys import hsv_to_rgb
-from datetime import datetime
-from json import dumps
-from time import sleep
+from datetime import date
+from functools import lru_cache
+from itertools import cycle
+from signal import SIGINT, SIGTERM, signal
+from threading import Event
+from time import monotonic, sleep
 from typing import TYPE_CHECKING, Any, Final
 
-from pigpio import pi  # type: ignore[import-untyped]
+import pigpio  # type: ignore[import-untyped]
+from paho.mqtt.client import MQTT_ERR_SUCCESS, error_string
 from wg_utilities.decorators import process_exception
 from wg_utilities.devices.dht22 import DHT22Sensor
 from wg_utilities.loggers import get_streaming_logger
@@ -17,6 +22,16 @@ from wg_utilities.utils import mqtt
 
 if TYPE_CHECKING:
     from collections.abc import Iterator
+    from threading import ExceptHookArgs
+
+    from paho.mqtt.client import Client, DisconnectFlags
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.reasoncodes import ReasonCode
+
+try:
+    from orjson import dumps
+except ImportError:  # pragma: no cover
+    from json import dumps  # type: ignore[assignment]
 
 LOGGER = get_streaming_logger(__name__)
 
@@ -116,6 +131,19 @@ BLUE = 13
 TEMP_LINE = f"Temp:  {{0:.1f}}{chr(223)}C"
 HUMID_LINE = "Humid: {0:.2f}%"
 
+MQTT_TOPIC: Final = f"/homeassistant/{mqtt.HOSTNAME}/dht22"
+
+READING_WAIT_SECONDS: Final = 0.25
+"""Time for a triggered reading to finish (or hit the 200ms watchdog) before use."""
+
+MAX_DISCONNECTED_SECONDS: Final = 300
+"""How long paho can spend failing to reconnect before climate_monitor exits to be
+restarted."""
+
+BAD_TEMP_VALUE: Final = float(DHT22Sensor.DEFAULT_TEMP_VALUE)
+BAD_RHUM_VALUE: Final = float(DHT22Sensor.DEFAULT_RHUM_VALUE)
+"""Placeholder values the sensor holds until it has taken a good reading."""
+
 
 class DisplayOTron:
     """Class for writing to Pimoroni's Display-O-Tron 3000."""
@@ -180,14 +208,35 @@ class DisplayOTron:
                 f"Unexpected number of lines to write ({len(lines)}, expected length 3",
             )
 
+        if wipe_null or all(lines):
+            self.write_frame(lines)
+            return
+
         for i, line in enumerate(lines):
-            if not line and wipe_null is False:
+            if not line:
                 continue
 
-            self.write_line(line_num=i, content=line or "")
+            self.write_line(line_num=i, content=line)
+
+    def write_frame(self, lines: list[str]) -> None:
+        """Write every line of the LCD in one go.
+
+        The LCD's memory for each line directly follows the previous one's, so the
+        whole (padded and truncated) frame can be written as one stream, rather than
+        moving the cursor to the start of each line.
+
+        Args:
+            lines (list): the content of each line, from the top
+        """
+        self.LCD.set_cursor_position(0, 0)
+        self.LCD.write(
+            "".join(
+                (line or "")[: self.MAX_LINE_LENGTH].ljust(self.MAX_LINE_LENGTH)
+                for line in lines
+            ),
+        )
 
 
-@process_exception(logger=LOGGER)
 def rgb_generator(
     num_steps: int = int(86400 / LOOP_DELAY_SECONDS),
 ) -> Iterator[tuple[float, ...]]:
@@ -199,15 +248,142 @@ def rgb_generator(
     Yields:
         tuple(float): a tuple of RGB intensities(?)
     """
-    hue = 0.0
-    step_val = 1.0 / num_steps
+    # The colour wheel repeats every `num_steps`, so work it out once up front and
+    # then just cycle through it
+    yield from cycle(
+        [
+            tuple(v * 100 for v in hsv_to_rgb(step / num_steps, 1, 1))
+            for step in range(num_steps)
+        ],
+    )
+
+
+@mqtt.CLIENT.disconnect_callback()
+def on_disconnect(
+    client: Client,
+    userdata: Any,
+    flags: DisconnectFlags,
+    rc: ReasonCode,
+    properties: Properties | None,
+) -> None:
+    """Log the disconnection, and leave reconnecting to paho's network loop.
+
+    This replaces the `on_disconnect` in `wg_utilities`, which retries from within the
+    callback (blocking the network thread while it does) and raises once it gives up.
+    """
+    _ = client, userdata, flags, properties
+
+    if rc == 0:
+        LOGGER.info("Disconnected from MQTT broker")
+    else:
+        LOGGER.error("Unexpected disconnection from MQTT broker: %r", rc)
+
+
+def stop_on_thread_exception(shutdown: Event, failed: Event) -> None:
+    """Stop the service if one of its threads dies, e.g. paho's network thread.
+
+    paho re-raises exceptions from its callbacks, which ends the network thread and
+    leaves nothing servicing the connection.
+
+    Args:
+        shutdown (Event): set to stop the main loop
+        failed (Event): set to make the service exit with a non-zero status
+    """
+
+    def on_thread_exception(args: ExceptHookArgs) -> None:
+        LOGGER.error(
+            "Thread %r died, exiting",
+            getattr(args.thread, "name", None),
+            exc_info=args.exc_value,
+        )
+        failed.set()
+        shutdown.set()
+
+    threading.excepthook = on_thread_exception
+
+
+def publish_reading(temp: float, rhum: float) -> None:
+    """Publish a reading to HA.
+
+    Args:
+        temp (float): the temperature, in Celsius
+        rhum (float): the relative humidity, as a percentage
+    """
+    payload = dumps({"temperature": temp, "humidity": rhum})
+
+    # Each reading is superseded by the next one, and HA only keeps the latest, so
+    # lost/duplicate readings don't matter: no PUBACK, no retain
+    msg = mqtt.CLIENT.publish(MQTT_TOPIC, payload=payload, qos=0, retain=False)
 
-    while True:
-        rgb = hsv_to_rgb(hue, 1, 1)
-        hue += step_val
-        hue %= 1.0  # cap hue at 1.0
+    if msg.rc != MQTT_ERR_SUCCESS:
+        LOGGER.error(
+            "Failed to publish DHT22 reading to %s (%s): %s",
+            MQTT_TOPIC,
+            error_string(msg.rc),
+            payload,
+        )
 
-        yield tuple(v * 100 for v in rgb)
+
+@lru_cache(maxsize=1)
+def format_date(day: date) -> str:
+    """Format the date for the LCD.
+
+    The date only changes once a day, so the last one is cached rather than
+    re-formatted on every reading.
+
+    Args:
+        day (date): the date to format
+
+    Returns:
+        str: the date, e.g. "Mon, 1 Jan 2024"
+    """
+    return day.strftime("%a, %-d %b %Y")
+
+
+def take_reading(dht22: DHT22Sensor, screen: DisplayOTron) -> None:
+    """Take a reading from the DHT22, and write it to the LCD and HA.
+
+    Args:
+        dht22 (DHT22Sensor): the sensor to read from
+        screen (DisplayOTron): the LCD to write the reading to
+    """
+    dht22.trigger()
+    sleep(READING_WAIT_SECONDS)
+
+    # The sensor's callback updates these in the background, so take one copy to keep
+    # the LCD and the payload showing the same reading
+    temp, rhum = round(dht22.temperature, 2), round(dht22.humidity, 2)
+
+    if temp == BAD_TEMP_VALUE or rhum == BAD_RHUM_VALUE:
+        # The LCD is left showing the last good reading
+        LOGGER.warning("Bad reading from DHT22")
+        return
+
+    screen.write_lines(
+        [
+            format_date(date.today()),  # noqa: DTZ011
+            TEMP_LINE.format(temp),
+            HUMID_LINE.format(rhum),
+        ],
+    )
+    publish_reading(temp, rhum)
+
+
+def connect_mqtt(shutdown: Event, failed: Event) -> None:
+    """Connect to the MQTT broker in the background.
+
+    One long-lived connection, serviced by paho's network thread, so each publish is
+    just queued rather than blocking the loop on the broker.
+
+    Args:
+        shutdown (Event): set to stop the main loop if the network thread dies
+        failed (Event): set to make the service exit with a non-zero status if it does
+    """
+    stop_on_thread_exception(shutdown, failed)
+
+    mqtt.CLIENT.reconnect_delay_set(min_delay=1, max_delay=10)
+    mqtt.CLIENT.connect_async(mqtt.MQTT_HOST)
+    mqtt.CLIENT.loop_start()
 
 
 @process_exception(logger=LOGGER)
@@ -223,7 +399,8 @@ def main() -> None:
     GPIO.setup(6, GPIO.OUT)
     GPIO.setup(13, GPIO.OUT)
 
-    dht22 = DHT22Sensor(pi(), DHT22_PIN)
+    pi = pigpio.pi()
+    dht22 = DHT22Sensor(pi, DHT22_PIN)
 
     red = GPIO.PWM(5, 100)
     green = GPIO.PWM(6, 100)
@@ -235,44 +412,49 @@ def main() -> None:
 
     screen = DisplayOTron()
 
+    shutdown = Event()
+    failed = Event()
+
+    for sig in (SIGINT, SIGTERM):
+        signal(sig, lambda *_: shutdown.set())
+
+    connect_mqtt(shutdown, failed)
+
+    last_connected = monotonic()
+
     try:
-        while True:
-            r_val, g_val, b_val = next(color)
-
-            red.ChangeDutyCycle(r_val)
-            green.ChangeDutyCycle(g_val)
-            blue.ChangeDutyCycle(b_val)
-
-            dht22.trigger()
-            screen.write_lines(
-                [
-                    datetime.now().strftime("%a, %-d %b %Y"),  # noqa: DTZ005
-                    TEMP_LINE.format(dht22.temperature),
-                    HUMID_LINE.format(dht22.humidity),
-                ],
-            )
+        while not shutdown.is_set():
+            if mqtt.CLIENT.is_connected():
+                last_connected = monotonic()
+            elif monotonic() - last_connected > MAX_DISCONNECTED_SECONDS:
+                LOGGER.error(
+                    "Disconnected from MQTT broker for over %is, exiting",
+                    MAX_DISCONNECTED_SECONDS,
+                )
+                failed.set()
+                break
 
-            mqtt.CLIENT.publish(
-                f"/homeassistant/{mqtt.HOSTNAME}/dht22",
-                payload=dumps(
-                    {
-                        "temperature": round(dht22.temperature, 2),
-                        "humidity": round(dht22.humidity, 2),
-                    },
-                ),
-                qos=0,
-                retain=False,
-            )
+            for led, duty_cycle in zip((red, green, blue), next(color), strict=True):
+                led.ChangeDutyCycle(duty_cycle)
 
-            sleep(LOOP_DELAY_SECONDS)
+            take_reading(dht22, screen)
 
-    except Exception:
+            shutdown.wait(LOOP_DELAY_SECONDS)
+    finally:
+        LOGGER.info("Shutting down")
         dot3k_lcd.clear()
         red.stop()
         green.stop()
         blue.stop()
         GPIO.cleanup()
-        raise
+        dht22.cancel()
+        pi.stop()
+        mqtt.CLIENT.disconnect()
+        mqtt.CLIENT.loop_stop()
+
+    if failed.is_set():
+        # Non-zero, so systemd records the restart as a failure
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -2,25 +2,73 @@
 
 from __future__ import annotations
 
-from contextlib import suppress
-from json import dumps
 from os import environ
-from time import sleep
+from signal import SIGINT, SIGTERM, signal
+from threading import Event
+from time import monotonic, sleep
 from typing import Final
 
 import pigpio  # type: ignore[import-untyped]
+from paho.mqtt.client import MQTT_ERR_SUCCESS, error_string
 from wg_utilities.decorators import process_exception
 from wg_utilities.devices.dht22 import DHT22Sensor
 from wg_utilities.loggers import get_streaming_logger
 from wg_utilities.utils import mqtt
 
+try:
+    from orjson import dumps
+except ImportError:  # pragma: no cover
+    from json import dumps  # type: ignore[assignment]
+
 LOGGER = get_streaming_logger(__name__)
 
 LOOP_DELAY_SECONDS: Final = 30
 
 DHT22_PIN: Final[int] = int(environ["DHT22_PIN"])
 
-MQTT_TOPIC = f"/homeassistant/{mqtt.HOSTNAME}/dht22"
+MQTT_TOPIC: Final = f"/homeassistant/{mqtt.HOSTNAME}/dht22"
+
+READING_WAIT_SECONDS: Final = 0.25
+"""How long a triggered reading can take: `trigger()` sets a 200ms pigpio watchdog,
+so by then the 40 bits have either all arrived or the reading has been abandoned."""
+
+BAD_TEMP_VALUE: Final = float(DHT22Sensor.DEFAULT_TEMP_VALUE)
+BAD_RHUM_VALUE: Final = float(DHT22Sensor.DEFAULT_RHUM_VALUE)
+"""Placeholder values the sensor holds until it has taken a good reading."""
+
+FORCE_RESEND_SECONDS: Final = 600
+"""Unchanged readings are still re-sent this often, so HA can tell the sensor is
+still alive."""
+
+
+def publish_reading(temp: float, rhum: float) -> bool:
+    """Publish a reading to HA.
+
+    Args:
+        temp (float): the temperature, in Celsius
+        rhum (float): the relative humidity, as a percentage
+
+    Returns:
+        bool: whether the reading was queued for sending
+    """
+    payload = dumps({"temperature": temp, "humidity": rhum})
+
+    # Fire-and-forget: paho's network thread sends it, and a lost reading is replaced
+    # by the next one anyway. Retained, as unchanged readings aren't re-sent every loop
+    msg = mqtt.CLIENT.publish(MQTT_TOPIC, payload=payload, qos=0, retain=True)
+
+    if msg.rc == MQTT_ERR_SUCCESS:
+        LOGGER.debug("Queued DHT22 reading for %s: %s", MQTT_TOPIC, payload)
+        return True
+
+    LOGGER.error(
+        "Failed to publish DHT22 reading to %s (%s): %s",
+        MQTT_TOPIC,
+        error_string(msg.rc),
+        payload,
+    )
+
+    return False
 
 
 @process_exception(logger=LOGGER)
@@ -29,6 +77,13 @@ def main() -> None:
     pi = pigpio.pi()
     dht22 = DHT22Sensor(pi, DHT22_PIN)
 
+    # Waiting on this (rather than sleeping) means SIGTERM/SIGINT stop the service
+    # mid-wait, instead of only after the next reading
+    shutdown = Event()
+
+    for sig in (SIGINT, SIGTERM):
+        signal(sig, lambda *_: shutdown.set())
+
     mqtt.CLIENT.connect(mqtt.MQTT_HOST)
     mqtt.CLIENT.loop_start()
 
@@ -37,44 +92,35 @@ def main() -> None:
             break
 
         LOGGER.info("Waiting for connection to MQTT broker...")
-        sleep(1)
-
-    with suppress(KeyboardInterrupt):
-        while mqtt.CLIENT.is_connected():
-            dht22.trigger()
-            sleep(1)
-
-            temp = round(dht22.temperature, 2)
-            rhum = round(dht22.humidity, 2)
-
-            if temp == float(dht22.DEFAULT_TEMP_VALUE) or rhum == float(
-                dht22.DEFAULT_RHUM_VALUE,
-            ):
-                LOGGER.warning("Bad reading from DHT22")
-                sleep(LOOP_DELAY_SECONDS)
-                continue
-
-            payload = dumps({"temperature": temp, "humidity": rhum})
-
-            msg = mqtt.CLIENT.publish(
-                MQTT_TOPIC,
-                payload=payload,
-                qos=0,
-                retain=False,
-            )
-
-            msg.wait_for_publish(timeout=5)
-
-            if msg.is_published():
-                LOGGER.debug("Published DHT22 reading to %s: %s", MQTT_TOPIC, payload)
-            else:
-                LOGGER.error(
-                    "Failed to publish DHT22 reading to %s: %s",
-                    MQTT_TOPIC,
-                    payload,
-                )
-
-            sleep(LOOP_DELAY_SECONDS)
+        if shutdown.wait(1):
+            break
+
+    # Sleeping until a fixed deadline (rather than for a fixed duration) stops the time
+    # spent taking and publishing each reading from drifting the cadence
+    deadline = monotonic()
+    last_reading: tuple[float, float] | None = None
+    last_sent = 0.0
+    while mqtt.CLIENT.is_connected() and not shutdown.is_set():
+        dht22.trigger()
+        sleep(READING_WAIT_SECONDS)
+
+        temp = round(dht22.temperature, 2)
+        rhum = round(dht22.humidity, 2)
+
+        if temp == BAD_TEMP_VALUE or rhum == BAD_RHUM_VALUE:
+            LOGGER.warning("Bad reading from DHT22")
+        elif (
+            (temp, rhum) != last_reading or monotonic() - last_sent > FORCE_RESEND_SECONDS
+        ) and publish_reading(temp, rhum):
+            last_reading, last_sent = (temp, rhum), monotonic()
+
+        deadline += LOOP_DELAY_SECONDS
+        if (delay := deadline - monotonic()) <= 0:
+            # Fallen behind schedule, so resync to a full interval from now instead of
+            # taking readings in a burst
+            deadline, delay = monotonic() + LOOP_DELAY_SECONDS, LOOP_DELAY_SECONDS
+
+        shutdown.wait(delay)
 
     LOGGER.info("Shutting down DHT22 sensor")
     pi.stop()
@@ -3,13 +3,16 @@
 from __future__ import annotations
 
 import re
+import threading
 import time
+from collections import Counter
 from enum import IntEnum
-from functools import lru_cache
-from json import loads
+from functools import partial
 from os import getenv
 from pathlib import Path
-from typing import TYPE_CHECKING, Any, Final
+from signal import SIGINT, SIGTERM, signal
+from threading import Event, Lock, Timer
+from typing import TYPE_CHECKING, Any, Final, cast
 
 import pigpio  # type: ignore[import-untyped]
 from wg_utilities.decorators import process_exception
@@ -17,31 +20,88 @@ from wg_utilities.loggers import get_streaming_logger
 from wg_utilities.utils import mqtt
 
 if TYPE_CHECKING:
-    from paho.mqtt.client import MQTTMessage
+    from threading import ExceptHookArgs
+
+    from paho.mqtt.client import (
+        CallbackOnConnect_v2,
+        Client,
+        ConnectFlags,
+        DisconnectFlags,
+        MQTTMessage,
+    )
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.reasoncodes import ReasonCode
+
+try:
+    from orjson import loads
+except ImportError:  # pragma: no cover
+    from json import loads
 
 LOGGER = get_streaming_logger(__name__)
 
 # =============================================================================
 # Constants
 
-ON_VALUES: Final = (True, 1, "1", "on", "true", "True")
-OFF_VALUES: Final = (False, 0, "0", "off", "false", "False")
+ON_VALUES: Final = frozenset((b"1", b"on", b"true", b"True"))
+OFF_VALUES: Final = frozenset((b"0", b"off", b"false", b"False"))
+PAYLOAD_STATES: Final = dict.fromkeys(ON_VALUES, True) | dict.fromkeys(OFF_VALUES, False)
+"""All accepted (raw) payload values, mapped to the pin state they ask for.
+
+Incoming messages are looked up in this without being decoded first.
+"""
+
+STATE_PAYLOADS: Final = (b"False", b"True")
+"""Pre-serialised outgoing payloads, indexed by the pin's new level."""
 
 KEBAB_PATTERN = re.compile(r"^(?:[a-z0-9]+-?)+[a-z0-9]+$")
 """Pattern for `kebab-case` strings."""
 
 MAPPING_FILE: Final = Path(__file__).parent / "gpio_mapping.json"
 
-MAPPING: dict[str, int] = loads(MAPPING_FILE.read_text())
+MAPPING: dict[str, int] = loads(MAPPING_FILE.read_bytes())
 """Mapping of topic suffixes to GPIO pins.
 
 e.g. {"cpu-fan": 17}
 """
 
+if invalid_suffixes := sorted(s for s in MAPPING if not KEBAB_PATTERN.fullmatch(s)):
+    raise ValueError(f"Invalid suffix(es) in {MAPPING_FILE.name}: {invalid_suffixes}")
+
+if invalid_pins := sorted(s for s, p in MAPPING.items() if type(p) is not int):
+    raise TypeError(f"Non-integer pin(s) in {MAPPING_FILE.name} for: {invalid_pins}")
+
+# `PIN_TO_TOPIC` would silently keep only the last suffix for a repeated pin
+if duplicate_pins := sorted(p for p, n in Counter(MAPPING.values()).items() if n > 1):
+    raise ValueError(f"Duplicate pin(s) in {MAPPING_FILE.name}: {duplicate_pins}")
+
+PIN_TO_TOPIC: Final = {
+    pin: f"/homeassistant/{mqtt.HOSTNAME}/gpio/{suffix}"
+    for suffix, pin in MAPPING.items()
+}
+"""Mapping of GPIO pins to their full MQTT topics, built (and validated) once."""
+
+TOPIC_TO_PIN: Final = {topic: pin for pin, topic in PIN_TO_TOPIC.items()}
+"""Inverse of `PIN_TO_TOPIC`, so incoming messages' topics can be looked up as-is."""
+
 PI: Final = pigpio.pi()
 
+WATCHDOG_INTERVAL: Final = 10
+"""How often (in seconds) `main` checks the connection to the MQTT broker."""
+
+MAX_DISCONNECTED_SECONDS: Final = 300
+"""How long paho can spend failing to reconnect before mqtt_gpio exits to be restarted."""
+
 NEXT_CHANGE: dict[int, float] = {}
-"""Mapping of GPIO pins to the next epoch time they can be changed."""
+"""Mapping of GPIO pins to the next (monotonic clock) time they can be changed."""
+
+PIN_STATE: dict[int, bool] = {}
+"""Mapping of GPIO pins to their last known state, to save asking pigpiod for it."""
+
+PENDING_CHANGE: dict[int, Timer] = {}
+"""Mapping of GPIO pins to changes which are waiting for the pin's cooldown to end."""
+
+PENDING_CHANGE_LOCK: Final = Lock()
+"""Guards `PENDING_CHANGE`, which both paho's network thread and the `Timer`s change."""
 
 DISABLE_PIN_CALLBACK: dict[int, bool] = {}
 """Mapping of GPIO pins to whether the next outgoing MQTT message should be suppressed.
@@ -55,6 +115,9 @@ Used to stop infinite loops of messages when the pin is changed by the script.
 COOLDOWN: Final = int(getenv("GPIO_COOLDOWN", "5"))
 """Minimum time between pin changes in seconds."""
 
+GLITCH_FILTER: Final = int(getenv("GPIO_GLITCH_FILTER", "10000"))
+"""Time in microseconds a pin's level must be stable for before a change is reported."""
+
 
 class NewPinState(IntEnum):
     """Enum for the possible states of the pin."""
@@ -62,112 +125,261 @@ class NewPinState(IntEnum):
     OFF = 0
     ON = 1
     WATCHDOG_TIMEOUT_NO_CHANGE = 2
+    """Only sent if `PI.set_watchdog` is used, which it isn't."""
 
 
-@lru_cache(maxsize=len(MAPPING))
-def get_topic(pin: int) -> str:
-    """Get the topic for a given pin."""
-    if not (suffix := next((k for k, v in MAPPING.items() if v == pin), None)):
-        raise ValueError(f"Pin {pin} not found in mapping")
-
-    if not KEBAB_PATTERN.fullmatch(suffix):
-        raise ValueError(f"Invalid suffix: {suffix}")
-
-    return f"/homeassistant/{mqtt.HOSTNAME}/gpio/{suffix}"
-
-
-@lru_cache(maxsize=len(MAPPING))
-def get_pin(topic: str) -> int:
-    """Get the pin for a given topic."""
-    return MAPPING[topic.split("/")[-1]]
+def get_pin(topic: str) -> int | None:
+    """Get the pin for a given topic, or None if it isn't one of the GPIO topics."""
+    return TOPIC_TO_PIN.get(topic)
 
 
 @mqtt.CLIENT.message_callback()
 def on_message(_: Any, __: Any, message: MQTTMessage) -> None:
     """Process env vars on MQTT message.
 
+    Invalid messages are logged and dropped rather than raised: this runs on paho's
+    network thread, which an exception would kill.
+
     Args:
         message (MQTTMessage): the message object from the MQTT subscription
     """
-    if (value := message.payload.decode()) not in ON_VALUES + OFF_VALUES:
-        raise ValueError(
-            f"Invalid value received ({value}). Must be one of: "
-            f"{ON_VALUES + OFF_VALUES}",
+    if (target_state := PAYLOAD_STATES.get(value := message.payload)) is None:
+        LOGGER.error(
+            "Invalid value received (%r) on topic %r. Must be one of: %s",
+            value,
+            message.topic,
+            sorted(PAYLOAD_STATES),
         )
+        return
+
+    if (gpio := get_pin(message.topic)) is None:
+        LOGGER.error("Received message %r on unknown topic %r", value, message.topic)
+        return
 
     LOGGER.info("Received message %r on topic %r", value, message.topic)
 
-    gpio = get_pin(message.topic)
-    target_state = value in ON_VALUES
+    with PENDING_CHANGE_LOCK:
+        # A newer command for the pin supersedes one still waiting for the cooldown
+        if pending := PENDING_CHANGE.pop(gpio, None):
+            pending.cancel()
+
+        # Includes `pin_callback`'s retained echo of every edge, which would otherwise
+        # hit the cooldown below and defer a pointless (or, if the pin changes again in
+        # the meantime, stale) write
+        if PIN_STATE[gpio] == target_state:
+            LOGGER.debug("Pin %i already in state %s", gpio, target_state)
+            return
+
+        # Enforce a cooldown period between pin changes, deferring (rather than
+        # sleeping for) the change so paho's network loop isn't blocked in the meantime
+        if (time_to_wait := NEXT_CHANGE.get(gpio, 0) - time.monotonic()) > 0:
+            LOGGER.warning(
+                "Waiting %.3f seconds before changing pin %i",
+                time_to_wait,
+                gpio,
+            )
+
+            PENDING_CHANGE[gpio] = Timer(
+                time_to_wait,
+                set_pending_pin,
+                args=(gpio,),
+                kwargs={"target_state": target_state},
+            )
+            PENDING_CHANGE[gpio].daemon = True
+            PENDING_CHANGE[gpio].start()
+            return
+
+    set_pin(gpio, target_state=target_state)
+
+
+def set_pin(gpio: int, *, target_state: bool) -> None:
+    """Set a pin to the given state, if it isn't already in it.
 
-    if bool(PI.read(gpio)) == target_state:
+    Args:
+        gpio (int): the GPIO pin to set
+        target_state (bool): the state to set the pin to
+    """
+    if PIN_STATE[gpio] == target_state:
         LOGGER.warning("Pin %i already in state %s", gpio, target_state)
         return
 
-    # Enforce a cooldown period between pin changes
-    if (time_to_wait := NEXT_CHANGE.get(gpio, 0) - time.time()) > 0:
-        LOGGER.warning("Waiting %.3f seconds before changing pin %i", time_to_wait, gpio)
-        time.sleep(time_to_wait)
-
-    LOGGER.info(
-        "Setting pin %i (%s) to %s",
-        gpio,
-        message.topic.split("/")[-1],
-        target_state,
-    )
+    LOGGER.info("Setting pin %i (%s) to %s", gpio, PIN_TO_TOPIC[gpio], target_state)
 
     DISABLE_PIN_CALLBACK[gpio] = True
 
     PI.write(gpio, target_state)
+    PIN_STATE[gpio] = target_state
 
 
-def pin_callback(gpio: int, level: NewPinState, tick: int) -> None:
-    """Callback for when the pin changes state."""
-    _ = tick
+@process_exception(logger=LOGGER, raise_after_processing=False)
+def set_pending_pin(gpio: int, *, target_state: bool) -> None:
+    """Apply a change which was deferred until the end of the pin's cooldown.
+
+    This runs on the change's `Timer` thread, so any exception is logged (and the
+    change dropped) here, rather than just being printed to stderr.
+
+    Args:
+        gpio (int): the GPIO pin to set
+        target_state (bool): the state to set the pin to
+    """
+    with PENDING_CHANGE_LOCK:
+        # Unless a newer change has already replaced this one
+        if PENDING_CHANGE.get(gpio) is threading.current_thread():
+            del PENDING_CHANGE[gpio]
+
+    set_pin(gpio, target_state=target_state)
 
-    if level == NewPinState.WATCHDOG_TIMEOUT_NO_CHANGE:
-        return
 
-    NEXT_CHANGE[gpio] = time.time() + COOLDOWN
+def pin_callback(gpio: int, level: NewPinState, tick: int, *, topic: str) -> None:
+    """Callback for when the pin changes state.
+
+    The topic is bound per pin (with `functools.partial`) when the callback is
+    registered, so it doesn't need looking up on each change.
+    """
+    _ = tick
+
+    # No watchdog is set on any of the pins, so `level` is always 0 or 1 here
+    NEXT_CHANGE[gpio] = time.monotonic() + COOLDOWN
+    PIN_STATE[gpio] = bool(level)
 
     if DISABLE_PIN_CALLBACK.get(gpio):
         LOGGER.debug("Suppressed outgoing MQTT message for pin %i", gpio)
         DISABLE_PIN_CALLBACK[gpio] = False
         return
 
-    topic = get_topic(gpio)
-    payload = bool(level)
+    payload = STATE_PAYLOADS[level]
 
     LOGGER.info(
-        "GPIO pin %i changed state to %r. Publishing %r to %r; cooldown until %i (%s).",
+        "GPIO pin %i changed state to %r. Publishing %r to %r; cooldown for %is.",
         gpio,
         level,
         payload,
         topic,
-        NEXT_CHANGE[gpio],
-        time.ctime(NEXT_CHANGE[gpio]),
+        COOLDOWN,
     )
 
     mqtt.CLIENT.publish(topic, payload, retain=True, qos=2)
 
 
+@mqtt.CLIENT.connect_callback()
+def on_connect(
+    client: Client,
+    userdata: Any,
+    flags: ConnectFlags,
+    rc: ReasonCode,
+    properties: Properties | None,
+) -> None:
+    """Log the (re)connection and (re)subscribe to the GPIO topics.
+
+    Subscribing here, rather than once in `main`, means the subscriptions are restored
+    whenever paho reconnects to the broker in the background.
+    """
+    # The decorator in `wg_utilities` widens the type to every paho callback version
+    cast("CallbackOnConnect_v2", mqtt.on_connect)(client, userdata, flags, rc, properties)
+
+    if rc == 0:
+        # One SUBSCRIBE packet for every topic, rather than one per pin
+        client.subscribe([(topic, 2) for topic in TOPIC_TO_PIN])
+
+        LOGGER.info("Subscribed to topics %r", list(TOPIC_TO_PIN))
+
+
+@mqtt.CLIENT.disconnect_callback()
+def on_disconnect(
+    client: Client,
+    userdata: Any,
+    flags: DisconnectFlags,
+    rc: ReasonCode,
+    properties: Properties | None,
+) -> None:
+    """Log the disconnection, and leave reconnecting to paho's network loop.
+
+    This replaces the `on_disconnect` in `wg_utilities`, which retries from within the
+    callback (blocking the network thread while it does) and raises once it gives up.
+    """
+    _ = client, userdata, flags, properties
+
+    if rc == 0:
+        LOGGER.info("Disconnected from MQTT broker")
+    else:
+        LOGGER.error("Unexpected disconnection from MQTT broker: %r", rc)
+
+
+def stop_on_thread_exception(shutdown: Event, failed: Event) -> None:
+    """Stop the service if one of its threads dies, e.g. paho's network thread.
+
+    paho re-raises exceptions from its callbacks, which ends the network thread and
+    leaves nothing servicing the connection.
+
+    Args:
+        shutdown (Event): set to stop the main loop
+        failed (Event): set to make the service exit with a non-zero status
+    """
+
+    def on_thread_exception(args: ExceptHookArgs) -> None:
+        LOGGER.error(
+            "Thread %r died, exiting",
+            getattr(args.thread, "name", None),
+            exc_info=args.exc_value,
+        )
+        failed.set()
+        shutdown.set()
+
+    threading.excepthook = on_thread_exception
+
+
 @process_exception(logger=LOGGER)
 def main() -> None:
     """Main function."""
+    for pin, topic in PIN_TO_TOPIC.items():
+        PIN_STATE[pin] = bool(PI.read(pin))
+
+        PI.callback(pin, pigpio.EITHER_EDGE, partial(pin_callback, topic=topic))
+
+        # Debounce in pigpiod, so only stable level changes wake up `pin_callback`
+        PI.set_glitch_filter(pin, GLITCH_FILTER)
+
+    shutdown = Event()
+    failed = Event()
+
+    for sig in (SIGINT, SIGTERM):
+        signal(sig, lambda *_: shutdown.set())
+
+    stop_on_thread_exception(shutdown, failed)
+
+    # paho doubles the delay after each failed reconnection attempt (up to this cap),
+    # so a broker outage isn't met with a constant stream of connection attempts. If
+    # it never comes back, the watchdog below gives up after `MAX_DISCONNECTED_SECONDS`
+    mqtt.CLIENT.reconnect_delay_set(min_delay=1, max_delay=128)
+
     mqtt.CLIENT.connect(mqtt.MQTT_HOST)
 
-    topic_suffix_pin_mapping: dict[str, int] = loads(MAPPING_FILE.read_text())
+    # paho's network thread handles (re)connecting and the incoming messages, leaving
+    # the main thread free to just wait to be stopped
+    mqtt.CLIENT.loop_start()
 
-    for pin in topic_suffix_pin_mapping.values():
-        topic = get_topic(pin)
+    last_connected = time.monotonic()
+    while not shutdown.wait(WATCHDOG_INTERVAL):
+        if mqtt.CLIENT.is_connected():
+            last_connected = time.monotonic()
+        elif time.monotonic() - last_connected > MAX_DISCONNECTED_SECONDS:
+            LOGGER.error(
+                "Disconnected from MQTT broker for over %is, exiting",
+                MAX_DISCONNECTED_SECONDS,
+            )
+            failed.set()
+            break
 
-        mqtt.CLIENT.subscribe(topic, qos=2)
+    LOGGER.info("Shutting down")
 
-        LOGGER.info("Subscribed to topic %r", topic)
+    mqtt.CLIENT.disconnect()
+    mqtt.CLIENT.loop_stop()
 
-        PI.callback(pin, pigpio.EITHER_EDGE, pin_callback)
+    PI.stop()
 
-    mqtt.CLIENT.loop_forever()
+    if failed.is_set():
+        # Non-zero, so systemd records the restart as a failure
+        raise SystemExit(1)
 
 
 if __name__ == "__main__":
@@ -2,14 +2,22 @@
 
 from __future__ import annotations
 
+import fcntl
 import socket
+import struct
+import threading
+import zlib
+from contextlib import suppress
 from dataclasses import dataclass, field
 from datetime import UTC, datetime
 from functools import lru_cache
-from json import dumps
-from os import getloadavg
-from time import sleep, time
-from typing import ClassVar, Final, TypedDict
+from os import O_RDONLY, getloadavg, pread, statvfs
+from os import open as open_fd
+from pathlib import Path
+from signal import SIGINT, SIGTERM, signal
+from threading import Event
+from time import monotonic, time
+from typing import TYPE_CHECKING, Any, ClassVar, Final, TypedDict, cast
 
 import psutil
 from wg_utilities.decorators import process_exception
@@ -17,13 +25,48 @@ from wg_utilities.functions import run_cmd
 from wg_utilities.loggers import get_streaming_logger
 from wg_utilities.utils import mqtt
 
+if TYPE_CHECKING:
+    from threading import ExceptHookArgs
+
+    from paho.mqtt.client import (
+        CallbackOnConnect_v2,
+        Client,
+        ConnectFlags,
+        DisconnectFlags,
+    )
+    from paho.mqtt.properties import Properties
+    from paho.mqtt.reasoncodes import ReasonCode
+
+try:
+    from orjson import dumps
+except ImportError:  # pragma: no cover
+    from json import dumps  # type: ignore[assignment]
+
 LOGGER = get_streaming_logger(__name__)
 
 # =============================================================================
 # Constants
 
+CPU_TEMP_FILE: Final = Path("/sys/class/thermal/thermal_zone0/temp")
+DISK_USAGE_PATH: Final = "/home"
+GIT_DIR: Final = Path(__file__).resolve().parents[3] / ".git"
 IP_FALLBACK: Final = f"{mqtt.HOSTNAME}.local"
 ONE_MINUTE: Final = 60
+PROC_MEMINFO: Final = Path("/proc/meminfo")
+PROC_NET_ROUTE: Final = Path("/proc/net/route")
+PROC_STAT: Final = Path("/proc/stat")
+STATS_TOPIC: Final = f"/homeassistant/{mqtt.HOSTNAME}/stats"
+STATUS_TOPIC: Final = f"{STATS_TOPIC}/status"
+"""Availability topic: `online` while connected, `offline` (via the LWT) otherwise."""
+
+MAX_DISCONNECTED_SECONDS: Final = 300
+"""How long paho can spend failing to reconnect before pi_stats exits to be restarted."""
+
+SIOCGIFADDR: Final = 0x8915
+"""`ioctl` request number for getting an interface's IPv4 address."""
+
+IOCTL_SOCKET: Final = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+"""Socket for the `SIOCGIFADDR` lookups; it's never bound, so one can be reused."""
 
 SERVICE_START_TIME: Final = datetime.now(UTC).isoformat()
 
@@ -46,37 +89,170 @@ class Stats(TypedDict):
     service_start_time: str
 
 
+def _packed_refs() -> tuple[dict[str, str], set[str]]:
+    """Get the refs from the repo's `packed-refs` file.
+
+    Returns:
+        dict: a mapping of ref names to SHAs; annotated tags are peeled to their commit
+        set: the names of the refs which are annotated tags
+    """
+    refs: dict[str, str] = {}
+    annotated: set[str] = set()
+
+    with suppress(FileNotFoundError):
+        ref = ""
+        for line in (GIT_DIR / "packed-refs").read_text().splitlines():
+            if line.startswith("#"):
+                continue
+
+            if line.startswith("^"):
+                # The peeled commit of the annotated tag on the previous line
+                refs[ref] = line[1:]
+                annotated.add(ref)
+            else:
+                sha, ref = line.split(" ", 1)
+                refs[ref] = sha
+
+    return refs, annotated
+
+
+def _peel(sha: str) -> str | None:
+    """Get the commit SHA that a (loose) annotated tag object points to.
+
+    Args:
+        sha (str): the SHA of a tag or commit object
+
+    Returns:
+        str: the SHA of the tagged commit, the input SHA if it isn't a tag, or None if
+            the object isn't loose (i.e. it's been packed) so can't be read here
+    """
+    try:
+        obj = zlib.decompress((GIT_DIR / "objects" / sha[:2] / sha[2:]).read_bytes())
+    except FileNotFoundError:
+        return None
+
+    header, _, body = obj.partition(b"\0")
+
+    if header.startswith(b"tag ") and body.startswith(b"object "):
+        return body[7:47].decode()
+
+    return sha
+
+
 @lru_cache(maxsize=1)
 def local_git_ref() -> str:
-    """Get the current git ref for the local repo."""
-    output, error = run_cmd("git describe --tags --exact-match", exit_on_error=False)
+    """Get the current git ref for the local repo.
 
-    if "no tag exactly matches" in error:
-        output, _ = run_cmd("git rev-parse --short HEAD")
+    The `.git` directory is read directly, rather than shelling out to `git`, to avoid
+    spawning processes on every cache refresh. `git` is only used if a loose tag's
+    object has been packed, as pack files aren't read here.
 
-    return output.strip()
+    As with `git describe`, annotated tags are preferred over lightweight ones.
+
+    Returns:
+        str: the tag that HEAD is exactly on, otherwise the short SHA of HEAD
+    """
+    packed_refs, annotated_refs = _packed_refs()
+
+    try:
+        head = (GIT_DIR / "HEAD").read_text().strip()
+
+        if head.startswith("ref: "):
+            ref = head.removeprefix("ref: ")
+
+            try:
+                head = (GIT_DIR / ref).read_text().strip()
+            except FileNotFoundError:
+                head = packed_refs[ref]
+    except (OSError, KeyError):
+        LOGGER.exception("Failed to resolve HEAD in %s", GIT_DIR)
+        return ""
+
+    tags = {
+        ref.removeprefix("refs/tags/"): (sha, ref in annotated_refs)
+        for ref, sha in packed_refs.items()
+        if ref.startswith("refs/tags/")
+    }
+
+    unpeeled = False
+    tags_dir = GIT_DIR / "refs" / "tags"
+    for tag_file in tags_dir.rglob("*"):
+        if tag_file.is_file():
+            sha = tag_file.read_text().strip()
+
+            if (peeled := _peel(sha)) is None:
+                # Still a match if it's a lightweight tag of HEAD
+                unpeeled, peeled = True, sha
+
+            tags[tag_file.relative_to(tags_dir).as_posix()] = peeled, peeled != sha
+
+    # (is lightweight, name) pairs, so that annotated tags sort first
+    matching_tags = sorted(
+        (not annotated, tag) for tag, (sha, annotated) in tags.items() if sha == head
+    )
+
+    if unpeeled and not (matching_tags and not matching_tags[0][0]):
+        # An annotated tag might (still) be on HEAD, so let `git` check the packs
+        output, _ = run_cmd(
+            f"git --git-dir={GIT_DIR} tag --points-at HEAD"
+            " --format=%(objecttype):%(refname:lstrip=2)",
+            exit_on_error=False,
+        )
+
+        if git_tags := sorted(
+            (object_type != "tag", tag)
+            for object_type, _, tag in (
+                line.partition(":") for line in output.splitlines()
+            )
+        ):
+            return git_tags[0][1]
+
+    return matching_tags[0][1] if matching_tags else head[:7]
 
 
 @lru_cache(maxsize=1)
 def local_ip() -> str:
     """Get the local IP address of the Pi.
 
-    https://stackoverflow.com/a/28950776/7689800
+    This is the address of the interface with the (lowest metric) default route, which
+    is looked up via `ioctl` rather than by "connecting" a UDP socket to work it out.
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(0)
-
     ip = IP_FALLBACK
 
     try:
-        s.connect(("10.254.254.254", 1))
-        ip = s.getsockname()[0]
+        # Iface Destination Gateway Flags RefCnt Use Metric Mask MTU Window IRTT
+        routes = [line.split() for line in PROC_NET_ROUTE.read_text().splitlines()[1:]]
+        iface = min(
+            (route for route in routes if route[1] == "00000000"),
+            key=lambda route: int(route[6]),
+        )[0]
+
+        ifreq = fcntl.ioctl(
+            IOCTL_SOCKET,
+            SIOCGIFADDR,
+            struct.pack("256s", iface[:15].encode()),
+        )
+
+        ip = socket.inet_ntoa(ifreq[20:24])
     except Exception:
         LOGGER.exception("Failed to get local IP address")
-    finally:
-        s.close()
 
-    return str(ip)
+    return ip
+
+
+def _cpu_times() -> tuple[int, int]:
+    """Get the cumulative busy and total CPU time from `/proc/stat`.
+
+    Returns:
+        tuple: the busy and total CPU time, in jiffies
+    """
+    with PROC_STAT.open("rb") as fin:
+        # cpu  user nice system idle iowait irq softirq steal guest guest_nice
+        times = [int(value) for value in fin.readline().split()[1:9]]
+
+    total = sum(times)
+
+    return total - times[3] - times[4], total
 
 
 @dataclass
@@ -85,60 +261,88 @@ class RaspberryPi:
 
     ACTIVE_GIT_REF: ClassVar[str] = local_git_ref()
 
-    STATS_TOPIC: ClassVar[str] = f"/homeassistant/{mqtt.HOSTNAME}/stats"
-
     boot_time: float = field(default_factory=psutil.boot_time)
     boot_time_iso: str = field(init=False)
 
     get_count: int = 0
 
+    _cpu_temp_fd: int = field(init=False, repr=False)
+    _cpu_times: tuple[int, int] = field(init=False, repr=False)
+    _stats: Stats = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        """Open the CPU temperature file, take the initial CPU sample, format boot time.
+
+        The stats dictionary is also created here (with the values which never change)
+        so that it can be updated in place on each cycle, rather than rebuilt.
+        """
+        self._cpu_temp_fd = open_fd(CPU_TEMP_FILE, O_RDONLY)
+        self._cpu_times = _cpu_times()
+
+        self.boot_time_iso = datetime.fromtimestamp(self.boot_time, tz=UTC).isoformat()
+
+        self._stats = Stats(
+            cpu_usage=0.0,
+            memory_usage=0.0,
+            temperature=0.0,
+            disk_usage_percent=0.0,
+            load_1m=0.0,
+            load_5m=0.0,
+            load_15m=0.0,
+            uptime=0,
+            boot_time="",
+            local_git_ref="",
+            active_git_ref=self.ACTIVE_GIT_REF,
+            local_ip="",
+            service_start_time=SERVICE_START_TIME,
+        )
+
     def get_stats(self) -> Stats:
         """Get the current stats for the Pi.
 
         Returns:
-            Stats: the current stats for the Pi.
+            Stats: the current stats for the Pi; the same (updated) dict on every call.
         """
-        # Doing this first and separately so the other properties don't affect the
-        # readings
+        # Doing these first and separately so the other readings don't affect them: the
+        # CPU sample's window is then the idle time since the previous cycle (primed in
+        # `__post_init__` for the first one), not the work done below
+        cpu_usage, memory_usage, disk_usage_percent = self._snapshot()
         load_1m, load_5m, load_15m = self.load_averages
 
-        cpu_usage, memory_usage, temperature, uptime = (
-            self.cpu_usage,
-            self.memory_usage,
-            self.cpu_temp,
-            self.uptime,
-        )
+        temperature, uptime = self.cpu_temp, self.uptime
 
         if self.get_count % 5 == 0:
             local_git_ref.cache_clear()
             local_ip.cache_clear()
 
-            self.boot_time = psutil.boot_time()
-            self.boot_time_iso = datetime.fromtimestamp(
-                self.boot_time,
-                tz=UTC,
-            ).isoformat()
+            # The boot time only changes if the clock is (significantly) adjusted, so
+            # only re-format it when it does
+            if (boot_time := psutil.boot_time()) != self.boot_time:
+                self.boot_time = boot_time
+                self.boot_time_iso = datetime.fromtimestamp(boot_time, tz=UTC).isoformat()
         elif local_ip() == IP_FALLBACK:
             local_ip.cache_clear()
 
         self.get_count += 1
 
-        return Stats(
-            cpu_usage=cpu_usage,
-            memory_usage=memory_usage,
-            temperature=temperature,
-            disk_usage_percent=self.disk_usage_percent,
-            load_1m=load_1m,
-            load_5m=load_5m,
-            load_15m=load_15m,
-            uptime=uptime,
-            boot_time=self.boot_time_iso,
-            local_git_ref=local_git_ref(),
-            active_git_ref=self.ACTIVE_GIT_REF,
-            local_ip=local_ip(),
-            service_start_time=SERVICE_START_TIME,
+        self._stats.update(
+            {
+                "cpu_usage": cpu_usage,
+                "memory_usage": memory_usage,
+                "temperature": temperature,
+                "disk_usage_percent": disk_usage_percent,
+                "load_1m": load_1m,
+                "load_5m": load_5m,
+                "load_15m": load_15m,
+                "uptime": uptime,
+                "boot_time": self.boot_time_iso,
+                "local_git_ref": local_git_ref(),
+                "local_ip": local_ip(),
+            },
         )
 
+        return self._stats
+
     @property
     def cpu_temp(self) -> float:
         """Get the current CPU temperature.
@@ -146,35 +350,48 @@ class RaspberryPi:
         Returns:
             float: the current CPU temperature in Celsius.
         """
-        output, _ = run_cmd("vcgencmd measure_temp")
-        return float(output.replace("temp=", "").replace("'C", ""))
+        # The file contains the temperature in millidegrees Celsius
+        return round(int(pread(self._cpu_temp_fd, 16, 0)) / 1000, 2)
 
-    @property
-    def disk_usage_percent(self) -> float:
-        """Get the current disk usage percentage.
+    def _snapshot(self) -> tuple[float, float, float]:
+        """Sample the CPU, memory, and disk usage in a single pass.
+
+        The kernel's files are read directly (rather than via `psutil`) so that each is
+        only opened and parsed once per cycle.
 
         Returns:
-            float: the current disk usage percentage.
+            tuple: the CPU, memory, and disk usage percentages.
         """
-        return float(round(psutil.disk_usage("/home").percent, 2))
+        busy, total = _cpu_times()
+        prev_busy, prev_total = self._cpu_times
+        self._cpu_times = busy, total
 
-    @property
-    def memory_usage(self) -> float:
-        """Get the current memory usage percentage.
+        cpu_usage = (
+            (busy - prev_busy) / (total - prev_total) * 100 if total > prev_total else 0.0
+        )
 
-        Returns:
-            float: the percentage of memory currently in use.
-        """
-        return float(round(psutil.virtual_memory().percent, 2))
+        meminfo: dict[bytes, int] = {}
+        with PROC_MEMINFO.open("rb") as fin:
+            for line in fin:
+                key, value = line.split(b":", 1)
+                meminfo[key] = int(value.split()[0])
 
-    @property
-    def cpu_usage(self) -> float:
-        """Get the current CPU usage percentage.
+                # MemAvailable always comes after MemTotal, nothing else is needed
+                if key == b"MemAvailable":
+                    break
 
-        Returns:
-            float: the percentage of CPU currently in use.
-        """
-        return float(round(psutil.cpu_percent(), 2))
+        mem_total = meminfo[b"MemTotal"]
+        memory_usage = (mem_total - meminfo[b"MemAvailable"]) / mem_total * 100
+
+        disk = statvfs(DISK_USAGE_PATH)
+        disk_used = (disk.f_blocks - disk.f_bfree) * disk.f_frsize
+        disk_usage_percent = disk_used / (disk_used + disk.f_bavail * disk.f_frsize) * 100
+
+        return (
+            round(min(max(cpu_usage, 0.0), 100.0), 2),
+            round(memory_usage, 2),
+            round(disk_usage_percent, 2),
+        )
 
     @property
     def load_averages(self) -> tuple[float, float, float]:
@@ -195,39 +412,171 @@ class RaspberryPi:
         return int(time() - self.boot_time)
 
 
+@mqtt.CLIENT.connect_callback()
+def on_connect(
+    client: Client,
+    userdata: Any,
+    flags: ConnectFlags,
+    rc: ReasonCode,
+    properties: Properties | None,
+) -> None:
+    """Log the (re)connection and mark this Pi as online."""
+    # The decorator in `wg_utilities` widens the type to every paho callback version
+    cast("CallbackOnConnect_v2", mqtt.on_connect)(client, userdata, flags, rc, properties)
+
+    if rc == 0:
+        client.publish(STATUS_TOPIC, b"online", qos=1, retain=True)
+
+
+@mqtt.CLIENT.disconnect_callback()
+def on_disconnect(
+    client: Client,
+    userdata: Any,
+    flags: DisconnectFlags,
+    rc: ReasonCode,
+    properties: Properties | None,
+) -> None:
+    """Log the disconnection, and leave reconnecting to paho's network loop.
+
+    This replaces the `on_disconnect` in `wg_utilities`, which retries from within the
+    callback (blocking the network thread while it does) and raises once it gives up.
+    """
+    _ = client, userdata, flags, properties
+
+    if rc == 0:
+        LOGGER.info("Disconnected from MQTT broker")
+    else:
+        LOGGER.error("Unexpected disconnection from MQTT broker: %r", rc)
+
+
+def stop_on_thread_exception(shutdown: Event, failed: Event) -> None:
+    """Stop the service if one of its threads dies, e.g. paho's network thread.
+
+    paho re-raises exceptions from its callbacks, which ends the network thread and
+    leaves nothing servicing the connection.
+
+    Args:
+        shutdown (Event): set to stop the main loop
+        failed (Event): set to make the service exit with a non-zero status
+    """
+
+    def on_thread_exception(args: ExceptHookArgs) -> None:
+        LOGGER.error(
+            "Thread %r died, exiting",
+            getattr(args.thread, "name", None),
+            exc_info=args.exc_value,
+        )
+        failed.set()
+        shutdown.set()
+
+    threading.excepthook = on_thread_exception
+
+
+def wait_for_connection(shutdown: Event, timeout: int = 120) -> None:
+    """Wait (for up to `timeout` seconds) for the client to connect to the broker.
+
+    Args:
+        shutdown (Event): stops the wait early if set, e.g. by SIGTERM
+        timeout (int): the maximum time to wait, in seconds
+    """
+    for _ in range(timeout):
+        if mqtt.CLIENT.is_connected():
+            return
+
+        LOGGER.info("Waiting for connection to MQTT broker...")
+        if shutdown.wait(1):
+            return
+
+
 @process_exception(logger=LOGGER)
 def main() -> None:
     """Sends system stats to Home Assistant every minute."""
     rasp_pi = RaspberryPi()
 
-    mqtt.CLIENT.connect(mqtt.MQTT_HOST)
+    # Waiting on this (rather than sleeping) lets SIGTERM/SIGINT stop the service
+    # straight away, instead of at the end of the current minute
+    shutdown = Event()
+    failed = Event()
+
+    for sig in (SIGINT, SIGTERM):
+        signal(sig, lambda *_: shutdown.set())
+
+    stop_on_thread_exception(shutdown, failed)
+
+    # paho's network thread reconnects by itself, so the publishing loop below only
+    # needs to give up if the connection stays down (see `MAX_DISCONNECTED_SECONDS`)
+    mqtt.CLIENT.reconnect_delay_set(min_delay=1, max_delay=10)
+
+    # The broker publishes this if the connection drops, so HA can mark the Pi as
+    # unavailable without this service having to poll the connection
+    mqtt.CLIENT.will_set(STATUS_TOPIC, b"offline", qos=1, retain=True)
+
+    # A shorter keepalive (than paho's 60s default) means the broker notices a dead
+    # connection, and sends the LWT, sooner
+    mqtt.CLIENT.connect_async(mqtt.MQTT_HOST, keepalive=30)
     mqtt.CLIENT.loop_start()
 
-    for _ in range(120):
+    wait_for_connection(shutdown)
+
+    # This is done as a while loop, rather than a cron job, so that instantiating the
+    # pi etc. every time doesn't influence the readings. Sleeping until a fixed deadline
+    # (rather than for a fixed duration) stops the time taken to collect and publish
+    # the stats from drifting the cadence.
+    deadline = last_connected = monotonic()
+    while not shutdown.is_set():
         if mqtt.CLIENT.is_connected():
+            last_connected = monotonic()
+        elif monotonic() - last_connected > MAX_DISCONNECTED_SECONDS:
+            LOGGER.error(
+                "Disconnected from MQTT broker for over %is, exiting",
+                MAX_DISCONNECTED_SECONDS,
+            )
+            failed.set()
             break
 
-        LOGGER.info("Waiting for connection to MQTT broker...")
-        sleep(1)
-
-    # This is done as a while loop, rather than a cron job, so that instantiating the
-    # pi etc. every time doesn't influence the readings
-    while mqtt.CLIENT.is_connected():
         try:
+            # QoS 0 because each reading is superseded a minute later; retained so
+            # that HA gets the latest stats straight away after it (re)subscribes
             mqtt.CLIENT.publish(
-                topic=rasp_pi.STATS_TOPIC,
+                topic=STATS_TOPIC,
                 payload=dumps(rasp_pi.get_stats()),
-                retain=False,
-                qos=1,
+                retain=True,
+                qos=0,
             )
         except TimeoutError:
             LOGGER.exception("%s timed out sending stats, exiting", mqtt.HOSTNAME)
             raise SystemExit from None
 
-        sleep(ONE_MINUTE)
-
-    LOGGER.info("Disconnected from MQTT broker, exiting")
-    raise SystemExit
+        deadline += ONE_MINUTE
+        if (delay := deadline - monotonic()) <= 0:
+            # Fallen behind schedule, so resync to a full minute from now instead of
+            # publishing in a burst
+            deadline, delay = monotonic() + ONE_MINUTE, ONE_MINUTE
+
+        shutdown.wait(delay)
+
+    LOGGER.info("Shutting down")
+
+    if failed.is_set():
+        # No clean disconnection here, so that the broker sends the LWT if it still
+        # thinks the client is connected. Non-zero, so systemd records the restart as
+        # a failure
+        mqtt.CLIENT.loop_stop()
+        raise SystemExit(1)
+
+    # The broker only sends the LWT for unexpected disconnections, so this is needed
+    # to mark the Pi as unavailable when the service is stopped. If it isn't connected,
+    # the LWT (or the lack of an "online" message) already does that
+    if mqtt.CLIENT.is_connected():
+        mqtt.CLIENT.publish(
+            STATUS_TOPIC,
+            b"offline",
+            qos=1,
+            retain=True,
+        ).wait_for_publish(timeout=5)
+
+    mqtt.CLIENT.disconnect()
+    mqtt.CLIENT.loop_stop()
 
 
 if __name__ == "__main__":